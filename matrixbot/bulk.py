@@ -0,0 +1,119 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import Queue
+import threading
+
+from . import ratelimit
+from . import utils
+
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+class BulkMembershipOperation():
+    '''Runs a membership action (invite_user or kick_user) of a room over a
+list of users with a bounded number of concurrent API calls.
+
+The users which are already in the target state according to the room state
+store are skipped. The outcome of every user is kept in 'results' (user_id ->
+(status, detail)) and the optional 'progress' callback is called with
+(completed, total) every 'progress_every' users.
+    '''
+    def __init__(self, bot, action, room_id, users, attempts=3,
+                 priority=ratelimit.INTERACTIVE, workers=4,
+                 progress=None, progress_every=50):
+        self.logger = utils.get_logger()
+        self.bot = bot
+        self.action = action
+        self.room_id = room_id
+        self.users = list(users)
+        self.attempts = attempts
+        self.priority = priority
+        self.workers = int(workers)
+        self.progress = progress
+        self.progress_every = int(progress_every)
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def _is_done(self, user_id):
+        membership = self.bot.room_state.get_membership(self.room_id, user_id)
+        if self.action == "invite_user":
+            return membership in ('join', 'invite')
+        if self.action == "kick_user":
+            # Kicking an invited user cancels the invitation
+            return membership is not None and membership not in ('join', 'invite')
+        return False
+
+    def _set_result(self, user_id, status, detail=None):
+        with self.lock:
+            self.results[user_id] = (status, detail)
+            completed = len(self.results)
+        if (
+            self.progress and self.progress_every > 0
+            and completed % self.progress_every == 0
+            and completed < len(self.users)
+        ):
+            self.progress(completed, len(self.users))
+
+    def _run_user(self, user_id):
+        if self._is_done(user_id):
+            self._set_result(user_id, SKIPPED)
+            return
+        self.logger.info("Bulk %s in %s over %s" % (
+            self.action, self.room_id, user_id))
+        res = self.bot.call_api(self.action, self.attempts,
+                                self.room_id, user_id,
+                                priority=self.priority)
+        if type(res) == dict:
+            self._set_result(user_id, DONE)
+        else:
+            self._set_result(user_id, FAILED, res)
+
+    def _worker(self, pending):
+        while True:
+            try:
+                user_id = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self._run_user(user_id)
+            except Exception, e:
+                self._set_result(user_id, FAILED, str(e))
+
+    def run(self):
+        pending = Queue.Queue()
+        for user_id in self.users:
+            pending.put(user_id)
+        threads = []
+        for i in range(max(1, min(self.workers, len(self.users)))):
+            t = threading.Thread(target=self._worker, args=(pending,),
+                                 name="bulk-%s" % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        self.logger.info(self.get_summary())
+        return self.results
+
+    def get_users(self, status):
+        return sorted(u for u, r in self.results.items() if r[0] == status)
+
+    def get_summary(self):
+        done = self.get_users(DONE)
+        skipped = self.get_users(SKIPPED)
+        failed = self.get_users(FAILED)
+        msg = "Action '%s' in room %s: %s done, %s skipped, %s failed" % (
+            self.action, self.room_id, len(done), len(skipped), len(failed))
+        if done:
+            msg += "\nDone: %s" % " ".join(done)
+        if skipped:
+            msg += "\nSkipped (nothing to do): %s" % " ".join(skipped)
+        for user_id in failed:
+            msg += "\nFailed %s: %s" % (user_id, self.results[user_id][1])
+        return msg
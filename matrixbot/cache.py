@@ -0,0 +1,238 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import collections
+import json
+import Queue
+import threading
+import time
+
+from . import utils
+
+
+MEMBERS_FORMAT_VERSION = 1
+
+
+def encode_members(res):
+    '''Compact representation of a /members response: only the membership
+of every user is kept, serialized as JSON with a format version.
+    '''
+    members = {}
+    for e in res.get('chunk', []):
+        if 'state_key' in e:
+            members[e['state_key']] = e.get('content', {}).get('membership')
+    return json.dumps(
+        {"v": MEMBERS_FORMAT_VERSION, "members": members},
+        separators=(',', ':'))
+
+
+def decode_members(data):
+    '''Rebuilds a minimal /members response (state_key and membership of
+every member) from encode_members(). Returns None for unknown formats.
+    '''
+    try:
+        data = json.loads(data)
+        if data.get("v") != MEMBERS_FORMAT_VERSION:
+            return None
+        members = data["members"]
+    except (TypeError, ValueError, AttributeError, KeyError):
+        return None
+    return {'chunk': [
+        {'type': 'm.room.member',
+         'state_key': user_id,
+         'content': {'membership': membership}}
+        for user_id, membership in members.items()]}
+
+
+class LRUCache():
+    '''Bounded in-process cache. The least recently used entries are dropped
+when it is full and every entry expires after 'timeout' seconds.
+    '''
+    def __init__(self, size, timeout):
+        self.size = int(size)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            expires, value = self.items.pop(key)
+            if expires < time.time():
+                return None
+            self.items[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + self.timeout, value)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class MembersCache():
+    '''Two-tier cache of the room members: an in-process LRU in front of
+memcached, in front of the /members API call.
+
+Entries are patched from the m.room.member events seen in the syncs so they
+don't get stale while cached. Only the membership of every member is cached
+(see encode_members()), which keeps big rooms under the memcached item limit.
+    '''
+    def __init__(self, bot, memcached, size, timeout, fetch_workers=4):
+        self.logger = utils.get_logger()
+        self.bot = bot
+        self.memcached = memcached
+        self.timeout = timeout
+        self.fetch_workers = int(fetch_workers)
+        self.local = LRUCache(size, timeout)
+        self.stats = {
+            "local_hits": 0,
+            "memcached_hits": 0,
+            "misses": 0,
+        }
+
+    def _key(self, room_id):
+        return "get_room_members-%s" % room_id
+
+    def get(self, room_id):
+        key = self._key(room_id)
+        res = self.local.get(key)
+        if res:
+            self.stats["local_hits"] += 1
+            self.logger.debug("get_room_members (local cached): %s" % (key))
+            return res
+        res = decode_members(self.memcached.get(key))
+        if res:
+            self.stats["memcached_hits"] += 1
+            self.local.set(key, res)
+            self.logger.debug("get_room_members (cached): %s" % (key))
+            return res
+        self.stats["misses"] += 1
+        res = self.bot.call_api("get_room_members", 2, room_id)
+        if type(res) == dict:
+            res = self.set(room_id, res)
+        self.logger.debug("get_room_members (non cached): %s" % (key))
+        return res
+
+    def get_many(self, room_ids):
+        '''Batched get(): the keys missing in the local cache are read with a
+single get_multi, the misses are fetched from the API concurrently and
+written back with a single set_multi. Returns a dict room_id -> members.
+        '''
+        res = {}
+        keys = {}
+        for room_id in room_ids:
+            key = self._key(room_id)
+            members = self.local.get(key)
+            if members:
+                self.stats["local_hits"] += 1
+                res[room_id] = members
+            else:
+                keys[key] = room_id
+        if not keys:
+            return res
+
+        try:
+            cached = self.memcached.get_multi(keys.keys())
+        except Exception, e:
+            self.logger.warning("Error reading the members from memcached: %s" % e)
+            cached = {}
+        for key, data in cached.items():
+            members = decode_members(data)
+            if members and key in keys:
+                self.stats["memcached_hits"] += 1
+                self.local.set(key, members)
+                res[keys.pop(key)] = members
+
+        fetched = self._fetch_many(keys.values())
+        self.stats["misses"] += len(keys)
+        mapping = {}
+        for room_id, members in fetched.items():
+            if type(members) == dict:
+                key = self._key(room_id)
+                data = encode_members(members)
+                members = decode_members(data)
+                self.local.set(key, members)
+                mapping[key] = data
+            res[room_id] = members
+        if mapping:
+            try:
+                self.memcached.set_multi(mapping, self.timeout)
+            except Exception, e:
+                self.logger.warning("Error writing the members to memcached: %s" % e)
+        self.logger.debug("get_room_members (batch): %s rooms, %s non cached" % (
+            len(res), len(fetched)))
+        return res
+
+    def _fetch_many(self, room_ids):
+        res = {}
+        if not room_ids:
+            return res
+        pending = Queue.Queue()
+        for room_id in room_ids:
+            pending.put(room_id)
+
+        def _fetch():
+            while True:
+                try:
+                    room_id = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                res[room_id] = self.bot.call_api("get_room_members", 2, room_id)
+
+        threads = []
+        for i in range(max(1, min(self.fetch_workers, len(room_ids)))):
+            t = threading.Thread(target=_fetch, name="members-fetch-%s" % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return res
+
+    def set(self, room_id, res):
+        '''Caches the members of the room and returns its compact form'''
+        key = self._key(room_id)
+        data = encode_members(res)
+        res = decode_members(data)
+        self.local.set(key, res)
+        self.memcached.set(key, data, self.timeout)
+        return res
+
+    def invalidate(self, room_id):
+        key = self._key(room_id)
+        self.local.delete(key)
+        self.memcached.delete(key)
+
+    def patch(self, room_id, events):
+        '''Applies m.room.member events on the cached members of the room.
+If the room is only in memcached, the entry is dropped there instead.
+        '''
+        key = self._key(room_id)
+        res = self.local.get(key)
+        if not res:
+            self.memcached.delete(key)
+            return
+        chunk = dict((e.get('state_key'), e) for e in res.get('chunk', []))
+        for e in events:
+            chunk[e['state_key']] = e
+        res = {'chunk': chunk.values()}
+        self.set(room_id, res)
+        self.logger.debug("get_room_members (patched): %s" % (key))
+
+    def get_stats(self):
+        res = dict(self.stats)
+        res["local_size"] = len(self.local)
+        return res
@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import threading
+import xmlrpclib
+
+import matrix_client.api
+import requests
+import requests.adapters
+
+_lock = threading.Lock()
+_session = None
+_response_hooks = []
+_settings = {
+    "pool_connections": 10,
+    "max_connections_per_host": 16,
+    "connect_timeout": 10,
+    "read_timeout": 90,
+}
+
+
+class PooledSession(requests.Session):
+    '''requests session with keep-alive connection pools per host and a
+default (connect, read) timeout for the requests which don't set one.
+    '''
+    def __init__(self, settings):
+        requests.Session.__init__(self)
+        self.timeout = (settings["connect_timeout"], settings["read_timeout"])
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=int(settings["pool_connections"]),
+            pool_maxsize=int(settings["max_connections_per_host"]),
+            pool_block=True)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self.hooks["response"] = list(_response_hooks)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return requests.Session.request(self, method, url, **kwargs)
+
+
+def configure(settings):
+    '''Sets the pool settings. The session is created again with them'''
+    global _session
+    with _lock:
+        _settings.update(settings)
+        _session = None
+
+
+def add_response_hook(hook):
+    '''Adds a requests response hook to the shared session'''
+    with _lock:
+        if hook in _response_hooks:
+            return
+        _response_hooks.append(hook)
+        if _session is not None:
+            _session.hooks["response"].append(hook)
+
+
+def remove_response_hook(hook):
+    '''Removes a hook added with add_response_hook'''
+    with _lock:
+        if hook not in _response_hooks:
+            return
+        _response_hooks.remove(hook)
+        if _session is not None and hook in _session.hooks["response"]:
+            _session.hooks["response"].remove(hook)
+
+
+def get_session():
+    '''Shared HTTP session of the bot core and the plugins'''
+    global _session
+    with _lock:
+        if _session is None:
+            _session = PooledSession(_settings)
+        return _session
+
+
+class _RequestsModule():
+    '''Stands for the requests module inside matrix_client.api, which calls
+requests.request() and so opens a new connection for every API call.
+    '''
+    def __init__(self, module):
+        self.module = module
+
+    def request(self, method, url, **kwargs):
+        return get_session().request(method, url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+
+def install_matrix_client():
+    '''Makes matrix_client < 0.2 send its requests through the shared session.
+Newer versions have a session per MatrixHttpApi, replaced by MatrixBot.
+    '''
+    module = getattr(matrix_client.api, "requests", None)
+    if module is requests:
+        matrix_client.api.requests = _RequestsModule(requests)
+
+
+class XMLRPCTransport(xmlrpclib.Transport):
+    '''xmlrpclib transport sending the calls through the shared session'''
+    def __init__(self, scheme="https"):
+        xmlrpclib.Transport.__init__(self)
+        self.scheme = scheme
+
+    def request(self, host, handler, request_body, verbose=0):
+        host, extra_headers, x509 = self.get_host_info(host)
+        headers = dict(extra_headers or [])
+        headers["Content-Type"] = "text/xml"
+        url = "%s://%s%s" % (self.scheme, host, handler)
+        response = get_session().post(url, data=request_body, headers=headers)
+        if response.status_code != 200:
+            raise xmlrpclib.ProtocolError(
+                host + handler, response.status_code, response.reason,
+                response.headers)
+        parser, unmarshaller = self.getparser()
+        parser.feed(response.content)
+        parser.close()
+        return unmarshaller.close()
@@ -6,93 +6,390 @@
 
 from __future__ import absolute_import
 
+import json
+import threading
+import time
+
 import ldap as LDAP
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 
 from . import utils
 
+_pools_lock = threading.Lock()
+_pools = {}
+
+
+class ConnectionPool():
+    '''Pool of persistent connections to a LDAP server.
+
+Connections are reused between queries. A connection idle for longer than
+'check_interval' seconds is checked with a whoami request before being
+reused, and a connection failing with SERVER_DOWN is dropped and the query
+retried once over a new connection.
+    '''
+    def __init__(self, uri, size=4, timeout=10, check_interval=60):
+        self.logger = utils.get_logger()
+        self.uri = uri
+        self.size = int(size)
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.idle = []  # (connection, last used time)
+
+    def _connect(self):
+        self.logger.debug("Connecting to LDAP: %s" % self.uri)
+        conn = LDAP.initialize(self.uri)
+        conn.set_option(LDAP.OPT_NETWORK_TIMEOUT, self.timeout)
+        conn.set_option(LDAP.OPT_REFERRALS, 0)
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.unbind_s()
+        except Exception:
+            pass
+
+    def _is_alive(self, conn):
+        try:
+            conn.whoami_s()
+            return True
+        except LDAP.LDAPError, e:
+            self.logger.debug("Dropping stale LDAP connection: %s" % e)
+            self._close(conn)
+            return False
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, last_used = self.idle.pop()
+            if time.time() < last_used + self.check_interval or self._is_alive(conn):
+                return conn
+        return self._connect()
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.time()))
+                return
+        self._close(conn)
+
+    def search(self, base, scope, filterstr, attrlist=None, timeout=-1,
+               page_size=0):
+        for attempt in (1, 2):
+            conn = self.acquire()
+            try:
+                if page_size > 0:
+                    res = self._search_paged(conn, base, scope, filterstr,
+                                             attrlist, timeout, page_size)
+                else:
+                    res = conn.search_st(base, scope, filterstr, attrlist,
+                                         timeout=timeout)
+            except (LDAP.SERVER_DOWN, LDAP.CONNECT_ERROR), e:
+                self._close(conn)
+                if attempt == 2:
+                    raise
+                self.logger.warning("LDAP connection lost, reconnecting: %s" % e)
+                continue
+            except Exception:
+                self._close(conn)
+                raise
+            self.release(conn)
+            return res
+
+    def _search_paged(self, conn, base, scope, filterstr, attrlist, timeout,
+                      page_size):
+        '''Search using the paged results control, so the results are not
+truncated by the size limit of the server. The control is not critical:
+servers without paging support just return the results in one go.
+        '''
+        control = SimplePagedResultsControl(
+            criticality=False, size=page_size, cookie='')
+        res = []
+        while True:
+            msgid = conn.search_ext(base, scope, filterstr, attrlist,
+                                    serverctrls=[control])
+            rtype, rdata, rmsgid, serverctrls = conn.result3(msgid,
+                                                             timeout=timeout)
+            res += rdata
+            cookies = [c.cookie for c in serverctrls
+                       if c.controlType == SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                return res
+            control.cookie = cookies[0]
+
+
+def get_pool(ldap_settings):
+    uri = ldap_settings["server"]
+    with _pools_lock:
+        if uri not in _pools:
+            _pools[uri] = ConnectionPool(
+                uri,
+                ldap_settings.get("pool_size", 4),
+                ldap_settings.get("network_timeout", 10),
+                ldap_settings.get("check_interval", 60))
+        return _pools[uri]
+
+
+def search(ldap_settings, base, filterstr, attrlist=None):
+    return get_pool(ldap_settings).search(
+        base, LDAP.SCOPE_SUBTREE, filterstr, attrlist,
+        timeout=ldap_settings.get("query_timeout", 30),
+        page_size=ldap_settings.get("page_size", 500))
+
 
 def get_custom_ldap_group_members(ldap_settings, group_name):
     logger = utils.get_logger()
-    ldap_server = ldap_settings["server"]
     ldap_base = ldap_settings["base"]
     get_uid = lambda x: x[1]["uid"][0]
     members = []
     try:
-        conn = LDAP.initialize(ldap_server)
         g_ldap_filter = ldap_settings[group_name]
         logger.debug("Searching members for %s: %s" % (group_name,
                                                        g_ldap_filter))
-        items = conn.search_s(ldap_base, LDAP.SCOPE_SUBTREE,
-                              attrlist=['uid'],
-                              filterstr=g_ldap_filter)
+        items = search(ldap_settings, ldap_base, g_ldap_filter,
+                       attrlist=['uid'])
         members = map(get_uid, items)
     except Exception, e:
         logger.error("Error getting custom group %s from LDAP: %s" % (group_name, e))
     return members
 
 
-def get_ldap_group_members(ldap_settings, group_name):
-    # base:dc=example,dc=com
-    # filter:(&(objectClass=posixGroup)(cn={group_name}))
-    logger = utils.get_logger()
-    ldap_server = ldap_settings["server"]
-    ldap_base = ldap_settings["groups_base"]
-    ldap_filter = "(&%s(%s={group_name}))" % (ldap_settings["groups_filter"], ldap_settings["groups_id"])
-    get_uid = lambda x: x.split(",")[0].split("=")[1]
-    try:
-        ad_filter = ldap_filter.replace('{group_name}', group_name)
-        conn = LDAP.initialize(ldap_server)
-        logger.debug("Searching members for %s: %s - %s - %s" % (group_name,
-                                                                 ldap_server,
-                                                                 ldap_base,
-                                                                 ad_filter))
-        res = conn.search_s(ldap_base, LDAP.SCOPE_SUBTREE, ad_filter)
-    except Exception, e:
-        logger.error("Error getting group from LDAP: %s" % e)
-
-    return map(get_uid, res[0][1]['uniqueMember'])
-
+def search_groups_members(ldap_settings, group_names, since=None,
+                          timestamps=None):
+    '''Returns the members of the given groups (group -> members list),
+fetched with a single OR filtered search per batch of groups instead of one
+search per group. Groups not found are missing in the result.
 
-def get_ldap_groups(ldap_settings):
-    '''Returns the a list of found LDAP groups filtered with the groups list in
-the settings
+With 'since' (a LDAP generalized time) only the groups modified since then
+are returned. If a 'timestamps' dict is given, it is filled with the
+modifyTimestamp of every group returned.
     '''
-    # filter:(objectClass=posixGroup)
-    # base:ou=Group,dc=example,dc=com
     logger = utils.get_logger()
-    ldap_server = ldap_settings["server"]
     ldap_base = ldap_settings["groups_base"]
-    ldap_filter = ldap_settings["groups_filter"]
-    ldap_groups = ldap_settings["groups"]
-    get_uid = lambda x: x[1]["cn"][0]
-    try:
-        conn = LDAP.initialize(ldap_server)
-        logger.debug("Searching groups: %s - %s - %s" % (ldap_server,
-                                                         ldap_base,
-                                                         ldap_filter))
-        res = conn.search_s(ldap_base, LDAP.SCOPE_SUBTREE, ldap_filter)
-        return filter((lambda x: x in ldap_groups), map(get_uid, res))
-    except Exception, e:
-        logger.error("Error getting groups from LDAP: %s" % e)
+    groups_id = ldap_settings["groups_id"]
+    batch_size = int(ldap_settings.get("batch_size", 50))
+    get_uid = lambda x: x.split(",")[0].split("=")[1]
+    changes_filter = ""
+    if since:
+        changes_filter = "(modifyTimestamp>=%s)" % escape_filter_chars(since)
+    res = {}
+    for i in range(0, len(group_names), batch_size):
+        batch = group_names[i:i + batch_size]
+        ldap_filter = "(&%s%s(|%s))" % (
+            ldap_settings["groups_filter"],
+            changes_filter,
+            "".join("(%s=%s)" % (groups_id, escape_filter_chars(g))
+                    for g in batch))
+        logger.debug("Searching members for %s groups: %s - %s" % (
+            len(batch), ldap_base, ldap_filter))
+        for dn, attrs in search(ldap_settings, ldap_base, ldap_filter,
+                                attrlist=[groups_id, 'uniqueMember',
+                                          'modifyTimestamp']):
+            for g in attrs.get(groups_id, []):
+                if g in batch:
+                    res[g] = map(get_uid, attrs.get('uniqueMember', []))
+                    if timestamps is not None and attrs.get('modifyTimestamp'):
+                        timestamps[g] = attrs['modifyTimestamp'][0]
+    return res
+
 
+def map_aliases(ldap_settings, users):
+    aliases = ldap_settings.get('users_aliases', {})
+    return map(lambda x: aliases.get(x, x), users)
 
-def get_ldap_groups_members(ldap_settings):
-    def map_aliases(x):
-        return ldap_settings.get('users_aliases', {}).get(x, x)
 
+def get_ldap_groups_members(ldap_settings, timestamps=None):
     ldap_groups = ldap_settings["groups"]
-    groups = get_ldap_groups(ldap_settings)
     res = {}
-    for g in groups:
-        res[g] = map(map_aliases, get_ldap_group_members(ldap_settings, g))
+    for g, members in search_groups_members(
+            ldap_settings, ldap_groups, timestamps=timestamps).items():
+        res[g] = map_aliases(ldap_settings, members)
 
     # pending groups to get members. filters for those groups are explicitelly
     # defined in the settings
-    custom_groups = filter((lambda x: x not in groups), ldap_groups)
+    custom_groups = filter((lambda x: x not in res), ldap_groups)
     for g in custom_groups:
-        res[g] = map(map_aliases, get_custom_ldap_group_members(ldap_settings, g))
+        res[g] = map_aliases(ldap_settings,
+                             get_custom_ldap_group_members(ldap_settings, g))
     return res
 
 
 def get_groups(ldap_settings):
     return ldap_settings["groups"]
+
+
+class GroupsSnapshot():
+    '''Versioned in-memory snapshot of the members of the configured groups
+(see get_ldap_groups_members).
+
+The first get_with_version() loads it. Once it is older than 'ttl' seconds,
+get_with_version() keeps returning it while a background thread crawls the
+directory again. When a
+memcached client is given the snapshot is shared through it, so the bot and
+the subscriber runs don't crawl the directory once each.
+
+In incremental mode refresh_changes() only fetches the group entries whose
+modifyTimestamp is not older than the newest one already seen, and patches
+them in the snapshot. Custom groups (defined by a filter over the users) and
+deleted groups are only updated by the full refreshes.
+    '''
+    memcached_key = "ldap-groups-snapshot"
+
+    def __init__(self, ldap_settings, ttl=300, memcached=None):
+        self.logger = utils.get_logger()
+        self.ldap_settings = ldap_settings
+        self.ttl = ttl
+        self.memcached = memcached
+        self.lock = threading.Condition(threading.Lock())
+        self.groups = None
+        self.version = 0
+        self.loaded_at = 0
+        self.high_water = None  # Newest modifyTimestamp seen
+        self.no_high_water_logged = False
+        self.refreshing = False
+
+    def get_with_version(self):
+        '''Returns the version of the snapshot and the snapshot'''
+        with self.lock:
+            version, groups = self.version, self.groups
+            expired = time.time() > self.loaded_at + self.ttl
+            if groups is not None and expired and not self.refreshing:
+                self.refreshing = True
+                t = threading.Thread(target=self._refresh, name="ldap-groups")
+                t.daemon = True
+                t.start()
+        if groups is None:
+            self.refresh()
+            with self.lock:
+                # Another thread may be loading it
+                while self.refreshing:
+                    self.lock.wait()
+                version, groups = self.version, self.groups or {}
+        return version, groups
+
+    def _get_shared(self):
+        if not self.memcached:
+            return None
+        try:
+            data = json.loads(self.memcached.get(self.memcached_key))
+            if time.time() <= data["loaded_at"] + self.ttl:
+                data.setdefault("high_water", None)
+                return data
+        except (TypeError, ValueError, KeyError):
+            pass
+        except Exception, e:
+            self.logger.warning("Error reading the LDAP groups from memcached: %s" % e)
+        return None
+
+    def _set_shared(self, groups, loaded_at, high_water=None):
+        if not self.memcached:
+            return
+        try:
+            self.memcached.set(self.memcached_key,
+                               json.dumps({"groups": groups,
+                                           "loaded_at": loaded_at,
+                                           "high_water": high_water}),
+                               int(self.ttl))
+        except Exception, e:
+            self.logger.warning("Error writing the LDAP groups to memcached: %s" % e)
+
+    def _acquire(self):
+        '''Marks a refresh as running. Returns False if there is one already'''
+        with self.lock:
+            if self.refreshing:
+                return False
+            self.refreshing = True
+            return True
+
+    def _release(self):
+        with self.lock:
+            self.refreshing = False
+            self.lock.notify_all()
+
+    def refresh(self, force=False):
+        '''Full refresh, skipped if another refresh is running. It takes the
+shared snapshot if it is still fresh, unless 'force' is set (as done by the
+scheduled refreshes, which would find the copy they wrote themselves).
+        '''
+        if self._acquire():
+            self._refresh(force)
+
+    def _refresh(self, force=False):
+        try:
+            shared = None if force else self._get_shared()
+            if shared:
+                groups, loaded_at = shared["groups"], shared["loaded_at"]
+                high_water = shared["high_water"]
+            else:
+                timestamps = {}
+                groups = get_ldap_groups_members(self.ldap_settings,
+                                                 timestamps=timestamps)
+                loaded_at = time.time()
+                high_water = max(timestamps.values()) if timestamps else None
+                self._set_shared(groups, loaded_at, high_water)
+            with self.lock:
+                if groups != self.groups:
+                    self.version += 1
+                self.groups = groups
+                self.loaded_at = loaded_at
+                self.high_water = high_water
+            self.logger.debug("LDAP groups snapshot version %s: %s groups" % (
+                self.version, len(groups)))
+        except Exception, e:
+            self.logger.error("Error refreshing the LDAP groups: %s" % e)
+            with self.lock:
+                # Keep the previous snapshot and retry after a new ttl
+                self.loaded_at = time.time()
+        finally:
+            self._release()
+
+    def refresh_changes(self):
+        '''Incremental refresh, skipped if another refresh is running. Falls
+back to a full refresh when there is no snapshot yet. Without a
+modifyTimestamp to start from (e.g. hidden to the bot by the ACLs) the
+changes are left to the full refreshes.
+        '''
+        with self.lock:
+            groups = self.groups
+            high_water = self.high_water
+        if groups is None:
+            return self.refresh()
+        if high_water is None:
+            if not self.no_high_water_logged:
+                self.no_high_water_logged = True
+                self.logger.warning(
+                    "No modifyTimestamp in the LDAP groups: the changes are "
+                    "only fetched by the full refreshes")
+            return
+        if self._acquire():
+            self._refresh_changes()
+
+    def _refresh_changes(self):
+        try:
+            with self.lock:
+                high_water = self.high_water
+            timestamps = {}
+            changed = search_groups_members(
+                self.ldap_settings, self.ldap_settings["groups"],
+                since=high_water, timestamps=timestamps)
+            with self.lock:
+                patched = dict(self.groups)
+                for g, members in changed.items():
+                    patched[g] = map_aliases(self.ldap_settings, members)
+                if timestamps:
+                    self.high_water = max([self.high_water] + timestamps.values())
+                if patched == self.groups:
+                    return
+                self.groups = patched
+                self.version += 1
+                loaded_at, high_water = self.loaded_at, self.high_water
+            self.logger.debug("LDAP groups snapshot version %s: %s groups changed" % (
+                self.version, len(changed)))
+            self._set_shared(patched, loaded_at, high_water)
+        except Exception, e:
+            self.logger.error("Error getting the LDAP groups changes: %s" % e)
+        finally:
+            self._release()
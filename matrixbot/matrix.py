@@ -6,23 +6,38 @@
 
 from matrix_client.api import MatrixRequestError
 from matrix_client.client import MatrixClient
-from matrix_client.room import Room
 
 # import pprint
+import json
 import time
 import re
 
 from . import utils
+from . import bulk
+from . import cache
+from . import httppool
 from . import ldap as bot_ldap
+from . import ratelimit
+from . import reconcile
+from . import roomstate
+from . import scheduler
+from . import selection
+from . import statefile
+from . import syncfilter
+from . import workers
 
 
 class MatrixBot():
     def __init__(self, settings):
-        self.sync_token = None
-
         self.logger = utils.get_logger()
         self.cache = utils.create_cache(settings)
         self.cache_timeout = int(settings["memcached"]["timeout"])
+        self.outbound = ratelimit.OutboundScheduler(settings["ratelimit"])
+        self.members_cache = cache.MembersCache(
+            self, self.cache,
+            settings["memcached"].get("local_size", 1024),
+            self.cache_timeout,
+            settings["memcached"].get("fetch_workers", 4))
 
         self.settings = settings
         self.period = settings["DEFAULT"]["period"]
@@ -38,49 +53,86 @@ class MatrixBot():
         self.allowed_join_rooms_ids = filter(lambda x: x != 'default', settings["allowed-join"].keys())
         self.default_allowed_join_rooms = settings["allowed-join"]["default"]
 
+        self.ldap_groups = bot_ldap.GroupsSnapshot(
+            settings["ldap"],
+            settings["ldap"].get("snapshot_ttl", 300),
+            self.cache if settings["ldap"].get("snapshot_shared", True) else None)
+        self.selector = selection.Selector(self)
+
+        self.state = statefile.StateFile(settings["sync"]["state_file"])
+        self.sync_token = self.state.get("next_batch")
+        # All the HTTP traffic goes through the shared connection pools
+        httppool.configure(settings["http"])
+        httppool.install_matrix_client()
         self.client = MatrixClient(self.uri)
-        self.token = self.client.login_with_password(username=self.username,
-                                                     password=self.password)
-
-        self.rooms = []
-        self.room_aliases = {}
+        if hasattr(self.client.api, "session"):
+            # matrix_client >= 0.2 sends through its own requests session
+            self.client.api.session = httppool.get_session()
+        self.token = None
+        self.login()
+
+        self.room_state = roomstate.RoomStateStore(self.get_user_id())
+        self.plugins_pool = workers.WorkerPool(
+            settings["runtime"]["plugin_workers"], "plugins")
+        self.scheduler = scheduler.Scheduler(
+            self.plugins_pool, settings["runtime"]["scheduler_tick"])
+        self.sync_backoff = 0
         self.plugins = []
         for plugin in settings['plugins'].itervalues():
             mod = __import__(plugin['module'], fromlist=[plugin['class']])
             klass = getattr(mod, plugin['class'])
             self.plugins.append(klass(self, plugin['settings']))
+        self.sync_filter = syncfilter.SyncFilter(self)
+        # Added once the bot is built, so a failed construction doesn't leave
+        # it registered. Removed by stop()
+        httppool.add_response_hook(self.outbound.response_hook)
+
+    def login(self):
+        # A saved session is reused if it belongs to the same account and
+        # homeserver. Otherwise the bot logs in (without the initial sync
+        # done by MatrixClient.login_with_password)
+        if (
+            self.state.get("access_token")
+            and self.state.get("uri") == self.uri
+            and self.state.get("user_id") == self.get_user_id()
+        ):
+            self.token = self.state.get("access_token")
+            self.client.token = self.token
+            self.client.user_id = self.state.get("user_id")
+            self.client.api.token = self.token
+            self.logger.info("Reusing the saved session (device %s)" % (
+                self.state.get("device_id")))
+            return
 
-    def _get_selected_users(self, groups_users_list):
-        def _add_or_remove_user(users, username, append):
-            username = self.normalize_user_id(username)
-            if append and username not in users["in"]:
-                users["in"].append(username)
-            if not append and username not in users["out"]:
-                users["out"].append(username)
-
-        ldap_settings = self.settings["ldap"]
-        append = True
-        users = {
-            "in": [],
-            "out": []
-        }
-        for item in groups_users_list:
-            if item == ("but"):
-                append = False
-            elif item.startswith("+"):
-                group_name = item[1:]
-                groups_members = bot_ldap.get_ldap_groups_members(ldap_settings)
-                if group_name in groups_members.keys():
-                    map(
-                        lambda x: _add_or_remove_user(users, x, append),
-                        groups_members[group_name])
-            else:
-                _add_or_remove_user(users, item, append)
+        login_args = {"user": self.username, "password": self.password}
+        if self.state.get("device_id"):
+            login_args["device_id"] = self.state.get("device_id")
+        response = self.client.api.login("m.login.password", **login_args)
+        self.token = response["access_token"]
+        self.client.token = self.token
+        self.client.user_id = response["user_id"]
+        self.client.api.token = self.token
+        self.logger.info("Logged in as %s (device %s)" % (
+            response["user_id"], response.get("device_id")))
+        self.state.update(access_token=self.token,
+                          device_id=response.get("device_id"),
+                          user_id=self.get_user_id(),
+                          uri=self.uri)
+
+    def relogin(self, e):
+        '''Logs in again if the error is due to an invalid access token (e.g.
+a revoked saved session). Returns if it did.
+        '''
+        if not (isinstance(e, MatrixRequestError) and e.code == 401):
+            return False
+        self.logger.warning("Saved session is not valid anymore: %s" % e)
+        self.state.update(access_token=None)
+        self.login()
+        return True
 
-        selected_users = filter(
-            lambda x: x not in users["out"],
-            users["in"])
-        return selected_users
+    def _get_selected_users(self, groups_users_list):
+        # Compiled and memoized by the selector (see selection.Selector)
+        return self.selector.select(groups_users_list)
 
     def normalize_user_id(self, user_id):
         if not user_id.startswith("@"):
@@ -111,22 +163,30 @@ class MatrixBot():
         return room_id
 
     def get_room_members(self, room_id):
-        key = "get_room_members-%s" % room_id
-        res = self.cache.get(key)
-        if res:
-            self.logger.debug("get_room_members (cached): %s" % (key))
-            return res
-        res = self.call_api("get_room_members", 2, room_id)
-        self.cache.set(key, res, self.cache_timeout)
-        self.logger.debug("get_room_members (non cached): %s" % (key))
-        return res
+        return self.members_cache.get(room_id)
+
+    def get_rooms_members(self, room_ids):
+        '''Batched get_room_members. Returns a dict room_id -> members'''
+        return self.members_cache.get_many(room_ids)
 
     def is_room_member(self, room_id, user_id):
+        '''Returns True or False, or None if the membership is unknown'''
+        res = self.room_state.is_room_member(room_id, user_id)
+        if res is not None:
+            return res
+        # Not in the index (lazy loaded member or unknown room)
         try:
-            r = Room(self.client, room_id)
-            return user_id in r.get_joined_members().keys()
+            res = self.get_room_members(room_id)
+            for r in res.get('chunk', []):
+                if (
+                    r.get('state_key') == user_id
+                    and r.get('content', {}).get('membership') == 'join'
+                ):
+                    return True
         except Exception, e:
-            return False
+            self.logger.warning("Membership of %s in %s is unknown: %s" % (
+                user_id, room_id, e))
+            return None
         return False
 
     def do_command(self, action, sender, room_id, body, attempts=3):
@@ -159,13 +219,18 @@ class MatrixBot():
             target_room_id = self.get_real_room_id(body_arg_list[0])
             body_arg_list = body_arg_list[1:]
 
-        if sender and not self.is_room_member(target_room_id, sender):
-            msg = "%s is not allowed for not members (%s) of the room (%s)" % (action, sender, target_room_id)
-            self.logger.warning(msg)
-            self.send_private_message(sender,
-                                      msg,
-                                      room_id)
-            return
+        if sender:
+            is_member = self.is_room_member(target_room_id, sender)
+            if is_member is None:
+                msg = "%s is not possible now: the membership of %s in the room (%s) can't be checked" % (action, sender, target_room_id)
+            elif not is_member:
+                msg = "%s is not allowed for not members (%s) of the room (%s)" % (action, sender, target_room_id)
+            if not is_member:
+                self.logger.warning(msg)
+                self.send_private_message(sender,
+                                          msg,
+                                          room_id)
+                return
 
         selected_users = self._get_selected_users(body_arg_list)
 
@@ -179,21 +244,32 @@ class MatrixBot():
                 room_id)
         else:
             if len(selected_users) > 0:
-                for user in selected_users:
-                    self.logger.info(
-                        " do_command (%s,%s,%s,dry_mode=%s)" % (
-                            action,
-                            target_room_id,
-                            user,
-                            dry_mode))
-                    res = self.call_api(action, attempts, target_room_id, user)
-                if sender:
-                    msg = '''Action '%s' in room %s over %s''' % (
+                self.logger.info(
+                    " do_command (%s,%s,%s users,dry_mode=%s)" % (
                         action,
                         target_room_id,
-                        " ".join(selected_users)
-                    )
-                    self.send_private_message(sender, msg, room_id)
+                        len(selected_users),
+                        dry_mode))
+                progress = None
+                if sender:
+                    def progress(completed, total):
+                        self.send_private_message(
+                            sender,
+                            "Action '%s' in room %s: %s/%s users" % (
+                                action, target_room_id, completed, total),
+                            room_id)
+                operation = bulk.BulkMembershipOperation(
+                    self, action, target_room_id, selected_users,
+                    attempts=attempts,
+                    priority=ratelimit.INTERACTIVE if sender else ratelimit.BULK,
+                    workers=self.settings["bulk"]["workers"],
+                    progress=progress,
+                    progress_every=self.settings["bulk"]["progress_every"])
+                operation.run()
+                if sender:
+                    self.send_private_message(sender,
+                                              operation.get_summary(),
+                                              room_id)
             elif sender:
                 self.send_private_message(sender,
                                           "No users found",
@@ -209,19 +285,49 @@ class MatrixBot():
             body = "bender: kick " + self.settings["revokations"][room_id]
             self.do_command("kick_user", None, room_id, body, attempts=1)
 
-    def call_api(self, action, max_attempts, *args):
+    def reconcile_memberships(self, dry_run=False):
+        '''Issues only the invites and kicks needed to reach the subscriptions
+and revokations. Returns the plan report (not applied in dry_run mode).
+        '''
+        reconciler = reconcile.Reconciler(self)
+        plans = reconciler.plan()
+        if not dry_run:
+            reconciler.apply(plans)
+        report = reconciler.format_report(plans, applied=not dry_run)
+        self.logger.info("Reconciliation%s:\n%s" % (
+            " plan (dry run)" if dry_run else "", report))
+        return report
+
+    def call_api(self, action, max_attempts, *args, **kwargs):
+        '''Calls the API method through the outbound scheduler. The priority
+keyword argument is ratelimit.INTERACTIVE (default) or ratelimit.BULK.
+Returns the response, or the error as a string when all the attempts failed.
+        '''
+        priority = kwargs.get("priority", ratelimit.INTERACTIVE)
         method = getattr(self.client.api, action)
-        attempts = max_attempts
-        while attempts > 0:
+        e = None
+        for attempt in range(max_attempts):
+            try:
+                self.outbound.acquire(action, priority)
+            except ratelimit.CircuitOpenError, e:
+                self.logger.warning("Call %s action with: %s - %s" % (action, args, e))
+                break
             try:
                 response = method(*args)
+                self.outbound.success()
                 self.logger.info("Call %s action with: %s" % (action, args))
                 self.logger.debug("Call response: %s" % (response))
                 return response
-            except MatrixRequestError, e:
-                self.logger.debug("Fail (%s/%s) in call %s action with: %s - %s" % (attempts, max_attempts, action, args, e))
-                attempts -= 1
-                time.sleep(5)
+            except (MatrixRequestError,) + ratelimit.CONNECTION_ERRORS, e:
+                self.logger.debug("Fail (%s/%s) in call %s action with: %s - %s" % (attempt + 1, max_attempts, action, args, e))
+                # The rate limit answers are handled at the HTTP layer (see
+                # OutboundScheduler.response_hook)
+                if isinstance(e, MatrixRequestError) and e.code < 500:
+                    self.outbound.success()
+                    break  # Client errors are not retried
+                self.outbound.failure()
+                if attempt + 1 < max_attempts:
+                    time.sleep(self.outbound.get_backoff(attempt))
         return str(e)
 
     def send_emote(self, room_id, message):
@@ -235,10 +341,9 @@ class MatrixBot():
             "format": "org.matrix.custom.html",
             "formatted_body": message
         }
-        return self.client.api.send_message_event(
-            room_id, "m.room.message",
-            content
-        )
+        return self.call_api("send_message_event", 3,
+                             room_id, "m.room.message",
+                             content)
 
     def send_message(self, room_id, message):
         return self.call_api("send_message", 3,
@@ -260,10 +365,22 @@ class MatrixBot():
                              user_room_id, message)
 
     def leave_empty_rooms(self):
-        self.logger.debug("leave_empty_rooms")
-        rooms = self.get_rooms()
+        # Run in background by the scheduler. Only the rooms whose membership
+        # changed since the last pass and which look like 1-to-1 rooms are
+        # checked against their members list
+        rooms = self.room_state.pop_dirty_rooms()
+        self.logger.debug("leave_empty_rooms: %s rooms changed" % len(rooms))
+        candidates = []
         for room_id in rooms:
-            res = self.get_room_members(room_id)
+            count = self.room_state.get_member_count(room_id)
+            if count is None or count > 2:
+                continue  # We are looking for a 1-to-1 room
+            candidates.append(room_id)
+
+        members = self.get_rooms_members(candidates)
+        empty_rooms = []
+        for room_id in candidates:
+            res = members.get(room_id)
             try:
                 members_list = res.get('chunk', [])
             except Exception, e:
@@ -273,28 +390,48 @@ class MatrixBot():
             if len(members_list) > 2:
                 continue  # We are looking for a 1-to-1 room
 
-            for r in res.get('chunk', []):
-                if 'user_id' in r and 'membership' in r:
-                    if r['membership'] == 'leave':
-                        self.call_api("kick_user", 1, room_id, self.get_user_id())
-                        try:
-                            self.call_api("forget_room", 1, room_id)
-                        except Exception, e:
-                            self.logger.warning("Some kind of error during the forget_room action: %s" % (e))
+            for r in members_list:
+                if r.get('content', {}).get('membership') == 'leave':
+                    empty_rooms.append(room_id)
+                    break
+
+        self.logger.debug("Members cache stats: %s" % self.members_cache.get_stats())
+
+        # Leave and forget calls done in a single batch at the end
+        for room_id in empty_rooms:
+            self.logger.info("Leaving the empty room %s" % room_id)
+            self.call_api("leave_room", 1, room_id,
+                          priority=ratelimit.BULK)
+            try:
+                self.call_api("forget_room", 1, room_id,
+                              priority=ratelimit.BULK)
+            except Exception, e:
+                self.logger.warning("Some kind of error during the forget_room action: %s" % (e))
 
     def get_private_room_with(self, user_id):
-        self.leave_empty_rooms()
         self.logger.debug("get_private_room_with")
 
-        rooms = self.get_rooms()
+        room_id = self.room_state.get_private_room(user_id)
+        if room_id:
+            return room_id
+
+        # Old 1-to-1 rooms missing in m.direct and whose members are not
+        # loaded are not indexed yet. Once found, they are. Only the rooms
+        # with at most 2 members can be one, so the rest are not checked
+        rooms = [r for r in self.get_rooms()
+                 if self.room_state.get_member_count(r) <= 2]
+        # Warm up the members cache of the candidates in one batch
+        self.get_rooms_members(rooms)
         for room_id in rooms:
             if self.is_private_room(room_id, self.get_user_id(), user_id):
+                self.set_private_room(user_id, room_id)
                 return room_id
 
         # Not room found then ...
         room_id = self.call_api("create_room", 3,
                                 None, False,
                                 [user_id])['room_id']
+        self.set_private_room(user_id, room_id)
         self.call_api(
             "send_message",
             3,
@@ -303,7 +440,22 @@ class MatrixBot():
         )
         return room_id
 
+    def set_private_room(self, user_id, room_id):
+        self.room_state.set_private_room(user_id, room_id)
+        # m.direct keeps the index across restarts and other clients
+        self.call_api("set_account_data", 1,
+                      self.get_user_id(), "m.direct",
+                      self.room_state.get_direct())
+
     def is_private_room(self, room_id, user1_id, user2_id=None):
+        # The 1-to-1 rooms of the bot are already classified from the sync
+        # responses, so no members list is needed for them
+        if not user2_id and user1_id == self.get_user_id():
+            res = self.room_state.is_private_room(room_id)
+            if res is not None:
+                self.logger.debug("Room %s is a 1-to-1 room: %s" % (room_id, res))
+                return res
+
         me = False  # me is true if the user1_id is in the room
         him = False  # him is true if the user2_id join or is already
 
@@ -540,10 +692,8 @@ class MatrixBot():
             if len(aliases) < 1:
                 self.logger.debug("Room %s hasn't got aliases. Skipping" % (r))
                 continue  # We are looking for rooms with alias
-            try:
-                name = self.client.api.get_room_name(r)['name']
-            except Exception, e:
-                self.logger.debug("Error getting the room name %s: %s" % (r, e))
+            name = self.room_state.get_room_name(r)
+            if not name:
                 name = "No named"
             rooms_msg_list.append("* %s - %s" % (name, " ".join(aliases)))
         msg += "\n".join(sorted(rooms_msg_list))
@@ -636,51 +786,129 @@ Available command aliases:
         except MatrixRequestError, e:
             self.logger.warning(e)
 
-    def _set_rooms(self, response_dict):
-        new_room_list = []
-        for rooms_types in response_dict['rooms'].keys():
-            for room_id in response_dict['rooms'][rooms_types].keys():
-                new_room_list.append(room_id)
-                self._set_room_aliases(room_id, response_dict['rooms'][rooms_types][room_id])
-        self.rooms = new_room_list
-
-    def _set_room_aliases(self, room_id, room_dict):
-        try:
-            aliases = []
-            for e in room_dict['state']['events']:
-                if e['type'] == 'm.room.aliases':
-                    aliases = e['content']['aliases']
-            self.room_aliases[room_id] = aliases
-        except Exception, e:
-            self.logger.debug("Error getting aliases for %s: %s" % (room_id, e))
-            self.logger.debug("Dict: %s" % (room_dict))
-
     def get_rooms(self):
-        return self.rooms
+        return self.room_state.get_rooms()
 
     def get_room_aliases(self, room_id):
-        return self.room_aliases[room_id] if room_id in self.room_aliases else []
+        return self.room_state.get_room_aliases(room_id)
 
-    def sync(self, ignore=False, timeout_ms=30000):
-        response = self.client.api.sync(self.sync_token, timeout_ms, full_state='true')
-        self._set_rooms(response)
+    def fast_forward(self):
+        # Skips the backlog getting just a fresh next_batch token. The room
+        # state store is left unloaded so the next sync asks for the full
+        # state of the rooms
+        ff_filter = json.dumps(self.sync_filter.get_fast_forward_definition())
+        try:
+            response = self.client.api.sync(None, 0, filter=ff_filter)
+        except MatrixRequestError, e:
+            if not self.relogin(e):
+                raise
+            response = self.client.api.sync(None, 0, filter=ff_filter)
         self.sync_token = response["next_batch"]
+        self.state.update(next_batch=self.sync_token)
+        self.logger.info("!!! sync_token (fast forward): %s" % (self.sync_token))
+
+    def poll(self, timeout_ms=30000):
+        # Only the first sync asks for the full state of the rooms. Later
+        # syncs just apply the state deltas into the room state store
+        full_state = not self.room_state.loaded
+        try:
+            response = self.client.api.sync(
+                self.sync_token, timeout_ms,
+                filter=self.sync_filter.get_filter(),
+                full_state='true' if full_state else None)
+        except Exception, e:
+            if self.relogin(e):
+                # The next poll syncs with the new access token
+                return None
+            self.sync_backoff = min(
+                max(self.sync_backoff * 2, self.settings["sync"]["error_backoff_min"]),
+                self.settings["sync"]["error_backoff_max"])
+            self.logger.error("Sync failed, retrying in %s seconds: %s" % (
+                self.sync_backoff, e))
+            time.sleep(self.sync_backoff)
+            return None
+        self.sync_backoff = 0
+
+        if full_state:
+            self.room_state.load(response)
+        else:
+            self.room_state.update(response)
+            self._patch_members_cache(response)
+        self.sync_token = response["next_batch"]
+        self.state.update(next_batch=self.sync_token)
         self.logger.info("!!! sync_token: %s" % (self.sync_token))
         self.logger.debug("Sync response: %s" % (response))
+        return response
+
+    def _patch_members_cache(self, response):
+        rooms = response.get('rooms', {})
+        for room_id, room_dict in rooms.get('join', {}).items():
+            events = [
+                e for e in (
+                    room_dict.get('state', {}).get('events', [])
+                    + room_dict.get('timeline', {}).get('events', []))
+                if e.get('type') == 'm.room.member' and 'state_key' in e
+            ]
+            if events:
+                self.members_cache.patch(room_id, events)
+        for room_id in rooms.get('leave', {}).keys():
+            self.members_cache.invalidate(room_id)
+
+    def start_jobs(self, handler=None):
+        self.scheduler.add_job(
+            "leave_empty_rooms", self.leave_empty_rooms,
+            self.settings["runtime"]["janitor_period"])
+        if self.settings["ldap"]["groups"]:
+            # Keeps the LDAP groups snapshot warm for the commands
+            self.scheduler.add_job(
+                "ldap groups snapshot",
+                lambda: self.ldap_groups.refresh(force=True),
+                self.ldap_groups.ttl)
+            if self.settings["ldap"].get("incremental", False):
+                self.scheduler.add_job(
+                    "ldap groups changes", self.ldap_groups.refresh_changes,
+                    self.settings["ldap"].get("incremental_period", 10))
+
+        # Plugins are polled by the scheduler, decoupled from the syncs. Each
+        # plugin sets its own period, jitter, max_concurrency and timeout.
+        # Plugins with a max_period greater than their period are polled with
+        # an adaptive interval between both
+        handler = handler or self.send_message
+        for plugin in self.plugins:
+            settings = plugin.settings
+            period = getattr(plugin, "period", settings.get("period", self.period))
+            max_period = getattr(plugin, "max_period", settings.get("max_period", period))
+            policy = None
+            if max_period > period:
+                policy = scheduler.AdaptiveInterval(period, max_period)
+            self.scheduler.add_job(
+                "plugin %s" % plugin.name,
+                lambda plugin=plugin: plugin.async(handler),
+                period,
+                jitter=settings.get("jitter", 0),
+                max_concurrency=settings.get("max_concurrency", 1),
+                timeout=settings.get(
+                    "timeout", self.settings["runtime"]["plugin_timeout"]),
+                policy=policy)
+        self.scheduler.start()
+
+    def stop(self):
+        self.scheduler.stop()
+        self.plugins_pool.stop()
+        httppool.remove_response_hook(self.outbound.response_hook)
+
+    def sync(self, ignore=False, timeout_ms=30000):
+        # There is no sleep between syncs: the long-poll itself waits when
+        # idle and returns as soon as there are new events
+        response = self.poll(timeout_ms)
+        if not response:
+            return False
 
         if not ignore:
-            # async to plugins
-            for plugin in self.plugins:
-                try:
-                    plugin.async(self.send_message)
-                except Exception, e:
-                    self.logger.error(
-                        "Error in plugin %s: %s" % (plugin.name, e)
-                    )
             # core
-            self.sync_invitations(response['rooms']['invite'])
-            self.sync_joins(response['rooms']['join'])
-        time.sleep(self.period)
+            self.sync_invitations(response['rooms'].get('invite', {}))
+            self.sync_joins(response['rooms'].get('join', {}))
+        return True
 
     def sync_invitations(self, invite_events):
         # TODO Clean code and also use only_local_domain setting
@@ -6,6 +6,7 @@ class BroadcastPlugin:
         self.logger = utils.get_logger()
         self.bot = bot
         self.settings = settings
+        self.event_types = ["m.room.message"]
         self.logger.info("BroadcastPlugin loaded (%(name)s)" % settings)
 
     def async(self, handler):
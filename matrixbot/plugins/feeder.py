@@ -1,7 +1,7 @@
 import feedparser
 import pytz
-import time
 from datetime import datetime, timedelta
+from matrixbot import httppool
 from matrixbot import utils
 from dateutil import parser
 
@@ -15,12 +15,15 @@ class FeederPlugin:
         self.logger = utils.get_logger()
         self.bot = bot
         self.settings = settings
+        self.event_types = []
         self.logger.info("FeederPlugin loaded (%(name)s)" % settings)
         self.timestamp = {}
         for feed in self.settings["feeds"].keys():
             self.timestamp[feed] = utcnow()
-        self.lasttime = time.time()
+        # Polled by the scheduler every period seconds, backing off up to
+        # max_period while the feeds are quiet
         self.period = self.settings.get('period', 60)
+        self.max_period = self.settings.get('max_period', self.period * 10)
 
     def pretty_entry(self, entry):
         title = entry.get("title", "New post")
@@ -35,16 +38,14 @@ class FeederPlugin:
 
     def async(self, handler):
         self.logger.debug("FeederPlugin async")
-        now = time.time()
-        if now < self.lasttime + self.period:
-            return  # Feeder is only updated each 'period' time
-        self.lasttime = now
-
         res = []
         for feed_name, feed_url in self.settings["feeds"].iteritems():
             self.logger.debug("FeederPlugin async: Fetching %s ..." % feed_name)
             try:
-                feed = feedparser.parse(feed_url)
+                r = httppool.get_session().get(feed_url)
+                r.raise_for_status()
+                feed = feedparser.parse(r.content,
+                                        response_headers=r.headers)
                 updated = feed.get('feed',{}).get(
                                                   'updated',
                                                   utcnow().isoformat()
@@ -62,7 +63,7 @@ class FeederPlugin:
                 self.logger.error("FeederPlugin got error in feed %s: %s" % (feed_name,e))
 
         if len(res) == 0:
-            return
+            return False
 
         res = map(
             self.pretty_entry,
@@ -72,6 +73,7 @@ class FeederPlugin:
         for room_id in self.settings["rooms"]:
             room_id = self.bot.get_real_room_id(room_id)
             self.bot.send_notice(room_id, message)
+        return True
 
     def command(self, sender, room_id, body, handler):
         self.logger.debug("FeederPlugin command")
@@ -1,5 +1,6 @@
 import xmlrpclib
 from datetime import datetime, timedelta
+from matrixbot import httppool
 from matrixbot import utils
 
 class TracPlugin:
@@ -8,10 +9,16 @@ class TracPlugin:
         self.name = "TracPlugin"
         self.bot = bot
         self.settings = settings
+        self.event_types = ["m.room.message"]
         self.logger.info("TracPlugin loaded (%(name)s)" % settings)
         self.timestamp = datetime.utcnow()
+        # Polled by the scheduler every period seconds, backing off up to
+        # max_period while there are no ticket changes
+        self.period = self.settings.get('period', 60)
+        self.max_period = self.settings.get('max_period', self.period * 10)
         self.server = xmlrpclib.ServerProxy(
-            '%(url_protocol)s://%(url_auth_user)s:%(url_auth_password)s@%(url_domain)s%(url_path)s/login/xmlrpc' % self.settings
+            '%(url_protocol)s://%(url_auth_user)s:%(url_auth_password)s@%(url_domain)s%(url_path)s/login/xmlrpc' % self.settings,
+            transport=httppool.XMLRPCTransport(self.settings["url_protocol"])
         )
 
     def pretty_ticket(self, ticket):
@@ -43,7 +50,7 @@ class TracPlugin:
                     res.append(ticket)
 
         if len(res) == 0:
-            return
+            return False
 
         res = map(
             self.pretty_ticket,
@@ -53,6 +60,7 @@ class TracPlugin:
         for room_id in self.settings["rooms"]:
             room_id = self.bot.get_real_room_id(room_id)
             self.bot.send_notice(room_id, message)
+        return True
 
     def command(self, sender, room_id, body, handler):
         self.logger.debug("TracPlugin command")
@@ -1,9 +1,8 @@
 import json
 import pytz
-import requests
 import urllib
-import time
 from datetime import datetime, timedelta
+from matrixbot import httppool
 from matrixbot import utils
 from dateutil import parser
 
@@ -27,6 +26,7 @@ class WKBotsFeederPlugin:
         self.logger = utils.get_logger()
         self.bot = bot
         self.settings = settings
+        self.event_types = []
         self.logger.info("WKBotsFeederPlugin loaded (%(name)s)" % settings)
         for builder_name, builder in self.settings["builders"].iteritems():
             if 'builder_name' not in builder:
@@ -37,8 +37,10 @@ class WKBotsFeederPlugin:
             set_property(self.settings, builder, "only_failures", default=True)
             set_property(self.settings, builder, "notify_recoveries", default=True)
             self.logger.info("WKBotsFeederPlugin loaded (%(name)s) builder: " % settings + json.dumps(builder, indent = 4))
-        self.lasttime = time.time()
+        # Polled by the scheduler every period seconds, backing off up to
+        # max_period while there are no new build jobs
         self.period = self.settings.get('period', 60)
+        self.max_period = self.settings.get('max_period', self.period * 10)
 
     def pretty_entry(self, builder):
         url = builder['last_buildjob_url_squema'] % {
@@ -67,16 +69,11 @@ class WKBotsFeederPlugin:
 
     def async(self, handler):
         self.logger.debug("WKBotsFeederPlugin async")
-        now = time.time()
-        if now < self.lasttime + self.period:
-            return  # Feeder is only updated each 'period' time
-        self.lasttime = now
-
-        res = []
+        changes = False
         for builder_name, builder in self.settings["builders"].iteritems():
             self.logger.debug("WKBotsFeederPlugin async: Fetching %s ..." % builder_name)
             try:
-                r = requests.get(builder['builds_url_squema'] % builder).json()
+                r = httppool.get_session().get(builder['builds_url_squema'] % builder).json()
                 failed = 'failed' in r['-2']['text']
                 last_buildjob = r['-2']['number']
                 last_comments = r['-2']['sourceStamp']['changes'][0]['comments']
@@ -90,6 +87,7 @@ class WKBotsFeederPlugin:
                 builder["failed"] = failed
                 builder["last_buildjob"] = last_buildjob
                 builder["last_comments"] = last_comments
+                changes = True
 
                 send_message = False
                 if not builder['only_failures']:
@@ -104,6 +102,7 @@ class WKBotsFeederPlugin:
                     self.sent(message)
             except Exception as e:
                 self.logger.error("WKBotsFeederPlugin got error in builder %s: %s" % (builder_name,e))
+        return changes
 
 
     def command(self, sender, room_id, body, handler):
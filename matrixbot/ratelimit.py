@@ -0,0 +1,205 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import random
+import re
+import threading
+import time
+
+import requests
+
+from . import utils
+
+try:
+    from matrix_client.errors import MatrixHttpLibError
+    CONNECTION_ERRORS = (MatrixHttpLibError,
+                         requests.exceptions.RequestException)
+except ImportError:
+    # Older matrix_client versions let the requests errors through
+    CONNECTION_ERRORS = (requests.exceptions.RequestException,)
+
+INTERACTIVE = 0
+BULK = 1
+
+# Endpoint class of every API method called through MatrixBot.call_api
+ENDPOINT_CLASSES = {
+    "send_message": "messages",
+    "send_notice": "messages",
+    "send_emote": "messages",
+    "send_message_event": "messages",
+    "invite_user": "membership",
+    "kick_user": "membership",
+    "join_room": "membership",
+    "leave_room": "membership",
+    "forget_room": "membership",
+    "create_room": "rooms",
+    "set_account_data": "rooms",
+}
+
+# Endpoint class of the client-server API paths, for the HTTP responses
+ENDPOINT_PATHS = [
+    (re.compile(r"/rooms/[^/]+/send/"), "messages"),
+    (re.compile(r"/rooms/[^/]+/(invite|kick|join|leave|forget)$"), "membership"),
+    (re.compile(r"/join/[^/]+$"), "membership"),
+    (re.compile(r"/createRoom$"), "rooms"),
+    (re.compile(r"/user/[^/]+/account_data/"), "rooms"),
+]
+
+
+def get_path_class(path):
+    for regex, endpoint_class in ENDPOINT_PATHS:
+        if regex.search(path):
+            return endpoint_class
+    return "default"
+
+
+def get_retry_after(response):
+    '''Returns the retry_after_ms of a M_LIMIT_EXCEEDED response in seconds'''
+    try:
+        return response.json().get("retry_after_ms", 0) / 1000.0
+    except (TypeError, ValueError, AttributeError):
+        return 0
+
+
+class TokenBucket():
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.blocked_until = 0
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_delay(self, now):
+        '''Seconds until a token is available'''
+        self.refill(now)
+        delay = max(0, self.blocked_until - now)
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return delay
+
+
+class CircuitBreaker():
+    '''Opens after 'threshold' consecutive failures and fails fast for
+'reset_timeout' seconds. Then one call is let through to probe the server.
+    '''
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = int(threshold)
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+
+    def allow(self, now):
+        if self.opened is None:
+            return True
+        if now >= self.opened + self.reset_timeout:
+            self.opened = now  # Half open: a single probe call
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self, now):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened = now
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class OutboundScheduler():
+    '''Admission control for the outbound API calls.
+
+Every call takes a token of the bucket of its endpoint class (messages,
+membership, rooms or default) before being sent. Bulk calls (subscriptions,
+revokations, janitor) wait while there are interactive calls waiting for the
+same bucket, so the replies to the users go first. A M_LIMIT_EXCEEDED answer
+blocks the bucket for the retry_after_ms given by the server, and a failing
+or unreachable homeserver opens a circuit breaker shared by all the classes.
+    '''
+    def __init__(self, settings):
+        self.logger = utils.get_logger()
+        self.settings = settings
+        self.lock = threading.Condition(threading.Lock())
+        self.buckets = {}
+        self.waiting = {}  # endpoint class -> interactive callers waiting
+        self.breaker = CircuitBreaker(settings["breaker_threshold"],
+                                      settings["breaker_timeout"])
+
+    def get_class(self, action):
+        return ENDPOINT_CLASSES.get(action, "default")
+
+    def _get_bucket(self, endpoint_class):
+        if endpoint_class not in self.buckets:
+            rates = self.settings["rates"]
+            self.buckets[endpoint_class] = TokenBucket(
+                rates.get(endpoint_class, rates["default"]),
+                self.settings["burst"])
+        return self.buckets[endpoint_class]
+
+    def acquire(self, action, priority=INTERACTIVE):
+        endpoint_class = self.get_class(action)
+        with self.lock:
+            bucket = self._get_bucket(endpoint_class)
+            if priority == INTERACTIVE:
+                self.waiting[endpoint_class] = self.waiting.get(endpoint_class, 0) + 1
+            try:
+                while True:
+                    now = time.time()
+                    if not self.breaker.allow(now):
+                        raise CircuitOpenError(
+                            "Homeserver unavailable: %s calls are suspended" % action)
+                    delay = bucket.get_delay(now)
+                    if priority == BULK and self.waiting.get(endpoint_class):
+                        delay = max(delay, 0.1)
+                    if delay <= 0:
+                        bucket.tokens -= 1
+                        return
+                    self.lock.wait(delay)
+            finally:
+                if priority == INTERACTIVE:
+                    self.waiting[endpoint_class] -= 1
+                    self.lock.notify_all()
+
+    def throttled(self, endpoint_class, retry_after):
+        with self.lock:
+            bucket = self._get_bucket(endpoint_class)
+            bucket.blocked_until = max(bucket.blocked_until,
+                                       time.time() + retry_after)
+        self.logger.warning("Rate limited on %s calls for %.1f seconds" % (
+            endpoint_class, retry_after))
+
+    def response_hook(self, response, *args, **kwargs):
+        '''requests response hook (see httppool.add_response_hook).
+
+matrix_client retries the M_LIMIT_EXCEEDED (429) answers by itself, sleeping
+inside the call, so they never reach call_api. They are caught here to block
+the bucket of the endpoint for the rest of the callers.
+        '''
+        if response.status_code == 429 and "/_matrix/" in response.url:
+            path = requests.utils.urlparse(response.url).path
+            self.throttled(get_path_class(path), get_retry_after(response))
+
+    def success(self):
+        with self.lock:
+            self.breaker.success()
+
+    def failure(self):
+        with self.lock:
+            self.breaker.failure(time.time())
+
+    def get_backoff(self, attempt):
+        '''Exponential backoff with full jitter'''
+        return random.uniform(0, min(self.settings["backoff_max"],
+                                     self.settings["backoff_min"] * 2 ** attempt))
@@ -0,0 +1,113 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+from . import bulk
+from . import ratelimit
+from . import utils
+
+
+class RoomPlan():
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.invite = []
+        self.kick = []
+        self.unchanged = 0
+        self.results = {}  # action -> BulkMembershipOperation.results
+
+    def is_empty(self):
+        return not self.invite and not self.kick
+
+
+class Reconciler():
+    '''Diff based alternative to invite_subscriptions and kick_revokations.
+
+The members of all the subscriptions and revokations rooms are read in a
+single batch (see MatrixBot.get_rooms_members) and compared with the users
+selected for every room, so only the missing invites and the pending kicks
+are issued. A user both subscribed and revoked in a room is kicked, as the
+revokations run last.
+    '''
+    def __init__(self, bot):
+        self.logger = utils.get_logger()
+        self.bot = bot
+
+    def get_selected_users(self, settings_section, room_id):
+        return self.bot._get_selected_users(
+            self.bot.settings[settings_section][room_id].split())
+
+    def plan(self):
+        subscriptions = dict(
+            (room_id, self.get_selected_users("subscriptions", room_id))
+            for room_id in self.bot.subscriptions_room_ids)
+        revokations = dict(
+            (room_id, self.get_selected_users("revokations", room_id))
+            for room_id in self.bot.revokations_rooms_ids)
+        room_ids = set(subscriptions.keys()) | set(revokations.keys())
+        snapshot = self.bot.get_rooms_members(room_ids)
+
+        plans = []
+        for room_id in sorted(room_ids):
+            plan = RoomPlan(room_id)
+            res = snapshot.get(room_id)
+            if type(res) != dict:
+                self.logger.warning(
+                    "Members of room %s unavailable, skipping it: %s" % (
+                        room_id, res))
+                continue
+            membership = dict(
+                (e.get('state_key'), e.get('content', {}).get('membership'))
+                for e in res.get('chunk', []))
+            revoked = set(revokations.get(room_id, []))
+            for user_id in subscriptions.get(room_id, []):
+                if user_id in revoked:
+                    continue
+                if membership.get(user_id) in ('join', 'invite', 'ban'):
+                    plan.unchanged += 1
+                else:
+                    plan.invite.append(user_id)
+            for user_id in revoked:
+                if membership.get(user_id) in ('join', 'invite'):
+                    plan.kick.append(user_id)
+                else:
+                    plan.unchanged += 1
+            plan.kick.sort()
+            plans.append(plan)
+        return plans
+
+    def apply(self, plans):
+        settings = self.bot.settings["bulk"]
+        for plan in plans:
+            for action, users in (("invite_user", plan.invite),
+                                  ("kick_user", plan.kick)):
+                if not users:
+                    continue
+                operation = bulk.BulkMembershipOperation(
+                    self.bot, action, plan.room_id, users,
+                    attempts=1,
+                    priority=ratelimit.BULK,
+                    workers=settings["workers"])
+                plan.results[action] = operation.run()
+        return plans
+
+    def format_report(self, plans, applied=False):
+        lines = []
+        for plan in plans:
+            line = "%s: %s to invite, %s to kick, %s unchanged" % (
+                plan.room_id, len(plan.invite), len(plan.kick), plan.unchanged)
+            if applied:
+                failed = []
+                for results in plan.results.values():
+                    failed += [u for u, r in results.items()
+                               if r[0] == bulk.FAILED]
+                line += ", %s failed" % len(failed)
+            lines.append(line)
+            if plan.invite:
+                lines.append("  + invite: %s" % " ".join(plan.invite))
+            if plan.kick:
+                lines.append("  - kick: %s" % " ".join(plan.kick))
+        if not lines:
+            lines.append("Nothing to reconcile")
+        return "\n".join(lines)
@@ -0,0 +1,245 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import threading
+
+from . import utils
+
+
+class RoomState():
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.membership = None  # join or invite
+        self.aliases = {}  # state_key (server) -> aliases list
+        self.name = None
+        self.members = {}  # user_id -> membership
+        self.joined = set()  # Joined members index
+        # Room summary counters. With lazy loaded members the members dict
+        # is partial, so these are the reliable counters when present
+        self.joined_count = None
+        self.invited_count = None
+        self.heroes = []
+        self.private = False  # Cached 1-to-1 classification
+
+    def get_aliases(self):
+        res = []
+        for aliases in self.aliases.values():
+            res += aliases
+        return res
+
+    def get_member_count(self):
+        if self.joined_count is not None:
+            return self.joined_count + (self.invited_count or 0)
+        return len([m for m in self.members.values() if m in ('join', 'invite')])
+
+    def is_member(self, user_id):
+        '''Returns if user_id is joined, or None if it can't be known because
+the members are not fully loaded.
+        '''
+        if user_id in self.joined:
+            return True
+        if user_id in self.members:
+            return False
+        if self.joined_count is not None and len(self.joined) >= self.joined_count:
+            return False
+        return None
+
+    def get_private_user(self, user_id):
+        '''Returns the other member if this is a 1-to-1 room of user_id'''
+        if self.membership != 'join' or self.get_member_count() != 2:
+            return None
+        others = [u for u, m in self.members.items()
+                  if m in ('join', 'invite') and u != user_id]
+        if len(others) == 0:
+            # The other member is not loaded but it is the room hero
+            others = [u for u in self.heroes if u != user_id]
+        if len(others) == 1:
+            return others[0]
+        return None
+
+
+class RoomStateStore():
+    '''In-memory view of the state of the rooms the bot is in.
+
+It is loaded once from a full state sync response and then patched with the
+state deltas included in every incremental sync response. It also classifies
+the 1-to-1 rooms of the bot from the room summaries and membership changes,
+and keeps an index of them (user_id -> room_id) together with the m.direct
+account data.
+    '''
+    def __init__(self, user_id):
+        self.logger = utils.get_logger()
+        self.lock = threading.RLock()
+        self.user_id = user_id
+        self.rooms = {}
+        self.private_rooms = {}  # user_id -> room_id
+        self.private_room_users = {}  # room_id -> user_id
+        self.direct = {}  # m.direct account data: user_id -> room_ids
+        self.dirty_rooms = set()  # Rooms with membership changes
+        self.loaded = False
+
+    def load(self, response):
+        with self.lock:
+            self.rooms = {}
+            self.private_rooms = {}
+            self.private_room_users = {}
+            self.update(response)
+            self.dirty_rooms = set(self.rooms.keys())
+            self.loaded = True
+        self.logger.debug("RoomStateStore loaded: %s rooms" % len(self.rooms))
+
+    def update(self, response):
+        rooms = response.get('rooms', {})
+        with self.lock:
+            for e in response.get('account_data', {}).get('events', []):
+                if e.get('type') == 'm.direct':
+                    self.direct = e.get('content', {})
+            for room_id, room_dict in rooms.get('join', {}).items():
+                room = self._get_room(room_id)
+                room.membership = 'join'
+                summary = room_dict.get('summary', {})
+                if 'm.joined_member_count' in summary:
+                    room.joined_count = summary['m.joined_member_count']
+                    self.dirty_rooms.add(room_id)
+                if 'm.invited_member_count' in summary:
+                    room.invited_count = summary['m.invited_member_count']
+                    self.dirty_rooms.add(room_id)
+                if 'm.heroes' in summary:
+                    room.heroes = summary['m.heroes']
+                self._apply_events(
+                    room, room_dict.get('state', {}).get('events', []))
+                self._apply_events(
+                    room, room_dict.get('timeline', {}).get('events', []))
+                self._index_private_room(room)
+            for room_id, room_dict in rooms.get('invite', {}).items():
+                room = self._get_room(room_id)
+                room.membership = 'invite'
+                self._apply_events(
+                    room, room_dict.get('invite_state', {}).get('events', []))
+            for room_id in rooms.get('leave', {}).keys():
+                if room_id in self.rooms:
+                    self.logger.debug("RoomStateStore: left room %s" % room_id)
+                    del self.rooms[room_id]
+                    self._unindex_private_room(room_id)
+                    self.dirty_rooms.discard(room_id)
+
+    def _get_room(self, room_id):
+        if room_id not in self.rooms:
+            self.rooms[room_id] = RoomState(room_id)
+        return self.rooms[room_id]
+
+    def _apply_events(self, room, events):
+        for e in events:
+            if 'state_key' not in e or 'type' not in e:
+                continue
+            content = e.get('content', {})
+            try:
+                if e['type'] == 'm.room.aliases':
+                    room.aliases[e['state_key']] = content.get('aliases', [])
+                elif e['type'] == 'm.room.name':
+                    room.name = content.get('name')
+                elif e['type'] == 'm.room.member':
+                    room.members[e['state_key']] = content.get('membership')
+                    if content.get('membership') == 'join':
+                        room.joined.add(e['state_key'])
+                    else:
+                        room.joined.discard(e['state_key'])
+                    self.dirty_rooms.add(room.room_id)
+            except Exception, ex:
+                self.logger.debug("Error applying event in room %s: %s - %s" % (
+                    room.room_id, e, ex))
+
+    def _index_private_room(self, room):
+        self._unindex_private_room(room.room_id)
+        room.private = (
+            room.membership == 'join' and room.get_member_count() == 2)
+        user_id = room.get_private_user(self.user_id)
+        if user_id:
+            self.private_rooms[user_id] = room.room_id
+            self.private_room_users[room.room_id] = user_id
+
+    def _unindex_private_room(self, room_id):
+        user_id = self.private_room_users.pop(room_id, None)
+        if user_id and self.private_rooms.get(user_id) == room_id:
+            del self.private_rooms[user_id]
+
+    def get_rooms(self):
+        with self.lock:
+            return self.rooms.keys()
+
+    def get_room_aliases(self, room_id):
+        with self.lock:
+            if room_id not in self.rooms:
+                return []
+            return self.rooms[room_id].get_aliases()
+
+    def get_room_name(self, room_id):
+        with self.lock:
+            if room_id not in self.rooms:
+                return None
+            return self.rooms[room_id].name
+
+    def get_member_count(self, room_id):
+        with self.lock:
+            if room_id not in self.rooms:
+                return None
+            return self.rooms[room_id].get_member_count()
+
+    def is_room_member(self, room_id, user_id):
+        with self.lock:
+            if room_id not in self.rooms or self.rooms[room_id].membership != 'join':
+                return None
+            return self.rooms[room_id].is_member(user_id)
+
+    def get_membership(self, room_id, user_id):
+        '''Returns the membership of user_id in the room, or None if unknown'''
+        with self.lock:
+            if room_id not in self.rooms:
+                return None
+            return self.rooms[room_id].members.get(user_id)
+
+    def is_private_room(self, room_id):
+        '''Returns if the room is a 1-to-1 room of the bot, or None if the
+room is unknown.
+        '''
+        with self.lock:
+            if room_id not in self.rooms:
+                return None
+            return self.rooms[room_id].private
+
+    def pop_dirty_rooms(self):
+        with self.lock:
+            rooms = self.dirty_rooms
+            self.dirty_rooms = set()
+            return rooms
+
+    def get_private_room(self, user_id):
+        with self.lock:
+            if user_id in self.private_rooms:
+                return self.private_rooms[user_id]
+            # Rooms flagged as direct whose members are not loaded yet
+            for room_id in self.direct.get(user_id, []):
+                room = self.rooms.get(room_id)
+                if (
+                    room and room.membership == 'join'
+                    and room.members.get(user_id) in (None, 'join', 'invite')
+                    and room.get_member_count() <= 2
+                ):
+                    return room_id
+            return None
+
+    def set_private_room(self, user_id, room_id):
+        with self.lock:
+            self._unindex_private_room(room_id)
+            self.private_rooms[user_id] = room_id
+            self.private_room_users[room_id] = user_id
+            direct_rooms = self.direct.setdefault(user_id, [])
+            if room_id not in direct_rooms:
+                direct_rooms.append(room_id)
+
+    def get_direct(self):
+        with self.lock:
+            return dict((u, list(r)) for u, r in self.direct.items())
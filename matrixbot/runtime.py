@@ -0,0 +1,110 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import Queue
+import threading
+import time
+import traceback
+
+from . import utils
+
+
+class ThreadedRuntime():
+    '''Runs the bot as independent tasks: the sync long-poll, a pool of
+command workers, the plugins polling (see MatrixBot.start_jobs) and the
+outbound messages sent by the plugins. A slow plugin, LDAP search or API call
+only stalls its own task.
+
+Plugins keep their interface: the handler given to async() queues the
+message in the outbound task instead of sending it inline.
+
+Every command worker has its own queue and the events are routed by room, so
+the events of a room are handled one at a time and in order.
+    '''
+    def __init__(self, bot, settings):
+        self.logger = utils.get_logger()
+        self.bot = bot
+        self.settings = settings
+        self.events = [Queue.Queue()
+                       for i in range(int(settings["command_workers"]))]
+        self.outbox = Queue.Queue()
+        self.running = threading.Event()
+        self.threads = []
+
+    def start(self):
+        self.running.set()
+        self._spawn("sync", self.sync_task)
+        for i in range(len(self.events)):
+            self._spawn("commands-%s" % i,
+                        lambda events=self.events[i]: self.commands_task(events))
+        self._spawn("outbound", self.outbound_task)
+        self.bot.start_jobs(self.send_message)
+
+    def stop(self):
+        self.bot.stop()
+        self.running.clear()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def run_forever(self):
+        self.start()
+        try:
+            while self.running.is_set():
+                time.sleep(1)
+        finally:
+            self.stop()
+
+    def _spawn(self, name, task):
+        t = threading.Thread(target=self._run_task, name=name, args=(name, task))
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def _run_task(self, name, task):
+        self.logger.debug("Runtime task %s started" % name)
+        while self.running.is_set():
+            try:
+                task()
+            except Exception, e:
+                self.logger.error("Unexpected error in task %s: %s" % (name, e))
+                self.logger.error(traceback.format_exc())
+                time.sleep(1)
+        self.logger.debug("Runtime task %s stopped" % name)
+
+    def sync_task(self):
+        response = self.bot.poll(int(self.settings["sync_timeout_ms"]))
+        if not response:
+            return
+        for room_id, invite_state in response['rooms'].get('invite', {}).items():
+            self._get_events_queue(room_id).put(("invite", room_id, invite_state))
+        for room_id, sync_room in response['rooms'].get('join', {}).items():
+            for event in sync_room["timeline"]["events"]:
+                self._get_events_queue(room_id).put(("event", room_id, event))
+
+    def _get_events_queue(self, room_id):
+        return self.events[hash(room_id) % len(self.events)]
+
+    def commands_task(self, events):
+        try:
+            kind, room_id, data = events.get(timeout=1)
+        except Queue.Empty:
+            return
+        if kind == "invite":
+            self.bot.sync_invitations({room_id: data})
+        else:
+            self.logger.debug(">>> (join) %s" % (room_id))
+            self.bot._process_event(room_id, data)
+
+    def outbound_task(self):
+        try:
+            room_id, message = self.outbox.get(timeout=1)
+        except Queue.Empty:
+            return
+        self.bot.send_message(room_id, message)
+
+    def send_message(self, room_id, message):
+        self.outbox.put((room_id, message))
@@ -0,0 +1,145 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import random
+import threading
+import time
+
+from . import utils
+
+
+class AdaptiveInterval():
+    '''Polling interval which goes back to min_interval when the job reports
+changes and grows exponentially up to max_interval while the job is quiet or
+failing.
+    '''
+    def __init__(self, min_interval, max_interval, factor=2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = min_interval
+
+    def update(self, changes):
+        if changes:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.factor, self.max_interval)
+        return self.interval
+
+
+class Job():
+    def __init__(self, name, func, interval, jitter=0, max_concurrency=1,
+                 timeout=None, policy=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.policy = policy
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.running = 0
+        self.runs = 0
+        self.rounds = 0  # Pending turns of the wheel before the job is due
+
+    def get_delay(self):
+        interval = self.policy.interval if self.policy else self.interval
+        return interval + random.uniform(0, self.jitter)
+
+
+class Scheduler():
+    '''Timer wheel running periodic jobs on a worker pool.
+
+The wheel has 'slots' buckets and advances one bucket every 'tick' seconds in
+its own thread, so the cost of a tick only depends on the jobs due in that
+bucket and not on how many jobs are registered. Jobs longer than a full turn
+of the wheel wait the needed number of rounds in their bucket.
+
+Jobs with an adaptive policy are rescheduled when they finish, using the
+interval resulting of their outcome: a job returning True reports changes, a
+job returning anything else or raising an exception is quiet or failing.
+    '''
+    def __init__(self, pool, tick=1.0, slots=60):
+        self.logger = utils.get_logger()
+        self.pool = pool
+        self.tick = float(tick)
+        self.wheel = [[] for i in range(int(slots))]
+        self.cursor = 0
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.thread = None
+
+    def add_job(self, name, func, interval, jitter=0, max_concurrency=1,
+                timeout=None, policy=None):
+        job = Job(name, func, interval, jitter, max_concurrency, timeout,
+                  policy)
+        # First run after a random fraction of the interval so the jobs
+        # registered at startup don't fire all at once
+        self._schedule(job, random.uniform(0, min(interval, self.tick * len(self.wheel))))
+        self.logger.debug("Job %s scheduled every %s seconds" % (name, interval))
+        return job
+
+    def _schedule(self, job, delay):
+        ticks = max(1, int(round(delay / self.tick)))
+        with self.lock:
+            job.rounds = (ticks - 1) // len(self.wheel)
+            slot = (self.cursor + ticks) % len(self.wheel)
+            self.wheel[slot].append(job)
+
+    def start(self):
+        if self.thread:
+            return
+        self.running.set()
+        self.thread = threading.Thread(target=self._loop, name="scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.thread = None
+
+    def _loop(self):
+        next_tick = time.time() + self.tick
+        while self.running.is_set():
+            time.sleep(max(0, next_tick - time.time()))
+            next_tick += self.tick
+            self.advance()
+
+    def advance(self):
+        with self.lock:
+            self.cursor = (self.cursor + 1) % len(self.wheel)
+            bucket = self.wheel[self.cursor]
+            due = [job for job in bucket if job.rounds == 0]
+            for job in bucket:
+                job.rounds -= 1
+            self.wheel[self.cursor] = [job for job in bucket if job.rounds >= 0]
+        for job in due:
+            self._run(job)
+            if not job.policy:
+                self._schedule(job, job.get_delay())
+        self.pool.check_overruns()
+
+    def _run(self, job):
+        with self.lock:
+            if job.running >= job.max_concurrency:
+                self.logger.debug("Job %s is still running. Skipping" % job.name)
+                return
+            job.running += 1
+            job.runs += 1
+            key = (job.name, job.runs)
+        self.pool.submit(key, job.name, job.timeout, self._call, job)
+
+    def _call(self, job):
+        changes = False
+        try:
+            changes = job.func() is True
+        finally:
+            with self.lock:
+                job.running -= 1
+            if job.policy:
+                interval = job.policy.update(changes)
+                self.logger.debug("Job %s next run in %s seconds" % (
+                    job.name, interval))
+                self._schedule(job, job.get_delay())
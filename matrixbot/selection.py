@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+from . import cache
+from . import utils
+
+# Compiled plans and results don't expire by time: results are invalidated
+# by the version of the groups snapshot
+NO_TIMEOUT = 10 ** 9
+
+
+class Selection():
+    '''Compiled users selection expression:
+
+    [@user|user|+group]... [but [@user|user|+group]...]
+
+The result is the union of the included terms minus the union of the
+excluded ones, in order of appearance.
+    '''
+    def __init__(self, tokens, normalize):
+        self.include = []  # ("user", user_id) or ("group", group_name)
+        self.exclude = []
+        terms = self.include
+        for item in tokens:
+            if item == "but":
+                terms = self.exclude
+            elif item.startswith("+"):
+                terms.append(("group", item[1:]))
+            else:
+                terms.append(("user", normalize(item)))
+        self.groups = set(name for kind, name in self.include + self.exclude
+                          if kind == "group")
+
+    def _iter_users(self, terms, groups_members, normalize):
+        for kind, name in terms:
+            if kind == "user":
+                yield name
+            else:
+                for user_id in groups_members.get(name, []):
+                    yield normalize(user_id)
+
+    def evaluate(self, groups_members, normalize):
+        excluded = set(self._iter_users(self.exclude, groups_members, normalize))
+        seen = set()
+        res = []
+        for user_id in self._iter_users(self.include, groups_members, normalize):
+            if user_id not in seen and user_id not in excluded:
+                seen.add(user_id)
+                res.append(user_id)
+        return res
+
+
+class Selector():
+    '''Memoized evaluation of the selection expressions: the plans are
+compiled once per expression and the results are kept per expression and
+version of the LDAP groups snapshot.
+    '''
+    def __init__(self, bot, size=256):
+        self.logger = utils.get_logger()
+        self.bot = bot
+        self.plans = cache.LRUCache(size, NO_TIMEOUT)
+        self.results = cache.LRUCache(size, NO_TIMEOUT)
+
+    def compile(self, tokens):
+        key = " ".join(tokens)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = Selection(tokens, self.bot.normalize_user_id)
+            self.plans.set(key, plan)
+        return plan
+
+    def select(self, tokens):
+        plan = self.compile(tokens)
+        version, groups_members = None, {}
+        if plan.groups:
+            version, groups_members = self.bot.ldap_groups.get_with_version()
+        key = (" ".join(tokens), version)
+        res = self.results.get(key)
+        if res is None:
+            res = plan.evaluate(groups_members, self.bot.normalize_user_id)
+            self.results.set(key, res)
+            self.logger.debug("Selection '%s' (groups version %s): %s users" % (
+                key[0], version, len(res)))
+        return list(res)
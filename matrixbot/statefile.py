@@ -0,0 +1,57 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import json
+import os
+import threading
+
+from . import utils
+
+
+class StateFile():
+    '''Small JSON file where the bot keeps the session (access token, device
+ID) and the last sync token between restarts. An empty path disables it.
+    '''
+    def __init__(self, path):
+        self.logger = utils.get_logger()
+        self.path = path
+        self.lock = threading.Lock()
+        self.values = {}
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.values = json.load(f)
+            self.logger.debug("State loaded from %s" % self.path)
+        except Exception, e:
+            self.logger.warning("Error loading the state file %s: %s" % (
+                self.path, e))
+            self.values = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def update(self, **kwargs):
+        with self.lock:
+            self.values.update(kwargs)
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            # The access token is stored here so only the owner can read it
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.values, f)
+            os.rename(tmp_path, self.path)  # Atomic replacement
+        except Exception, e:
+            self.logger.warning("Error saving the state file %s: %s" % (
+                self.path, e))
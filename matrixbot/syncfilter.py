@@ -0,0 +1,120 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import json
+
+from matrix_client.api import MatrixRequestError
+
+from . import utils
+
+# Events the core needs: text messages for the commands and the state events
+# kept in the room state store
+CORE_TIMELINE_TYPES = [
+    "m.room.message",
+    "m.room.member",
+    "m.room.aliases",
+    "m.room.name",
+]
+CORE_STATE_TYPES = [
+    "m.room.member",
+    "m.room.aliases",
+    "m.room.name",
+]
+
+# m.direct feeds the index of 1-to-1 rooms
+CORE_ACCOUNT_DATA_TYPES = [
+    "m.direct",
+]
+
+# Smallest timeline accepted everywhere. Some servers treat a zero limit as
+# no limit at all
+FAST_FORWARD_TIMELINE_LIMIT = 1
+
+# Plugins which don't declare their event_types only get events through
+# command(), that is, m.room.message events
+DEFAULT_PLUGIN_EVENT_TYPES = ["m.room.message"]
+
+
+class SyncFilter():
+    '''Builds the sync filter from what the core and the loaded plugins need
+and uploads it to the homeserver once.
+    '''
+    def __init__(self, bot):
+        self.logger = utils.get_logger()
+        self.bot = bot
+        self.settings = bot.settings["sync"]
+        self.filter = None
+
+    def get_timeline_types(self):
+        types = list(CORE_TIMELINE_TYPES)
+        for plugin in self.bot.plugins:
+            for t in getattr(plugin, "event_types", DEFAULT_PLUGIN_EVENT_TYPES):
+                if t not in types:
+                    types.append(t)
+        return types
+
+    def get_definition(self, timeline_limit=None):
+        if timeline_limit is None:
+            timeline_limit = int(self.settings["timeline_limit"])
+        lazy_load_members = bool(self.settings["lazy_load_members"])
+        return {
+            "presence": {"types": []},
+            "account_data": {"types": list(CORE_ACCOUNT_DATA_TYPES)},
+            "room": {
+                "ephemeral": {"types": []},
+                "account_data": {"types": []},
+                "state": {
+                    "types": list(CORE_STATE_TYPES),
+                    "lazy_load_members": lazy_load_members,
+                },
+                # The events sent by the bot are not filtered out: the room
+                # state store must see the invites and kicks done by the bot.
+                # _process_event already ignores its own messages
+                "timeline": {
+                    "types": self.get_timeline_types(),
+                    "limit": timeline_limit,
+                    "lazy_load_members": lazy_load_members,
+                },
+            },
+        }
+
+    def get_fast_forward_definition(self):
+        '''Filter for the startup sync which only wants the next_batch token:
+no rooms, no state and the shortest possible timeline.
+        '''
+        return {
+            "presence": {"types": []},
+            "account_data": {"types": []},
+            "room": {
+                "rooms": [],
+                "ephemeral": {"types": []},
+                "account_data": {"types": []},
+                "state": {"types": []},
+                "timeline": {
+                    "types": [],
+                    "limit": FAST_FORWARD_TIMELINE_LIMIT,
+                },
+            },
+        }
+
+    def get_filter(self):
+        '''Returns the ID of the uploaded filter. If the filter can't be
+uploaded, the filter definition is returned as JSON which is also accepted by
+the sync endpoint, and the upload is tried again on the next call.
+        '''
+        if self.filter:
+            return self.filter
+        definition = self.get_definition()
+        self.logger.debug("Sync filter definition: %s" % definition)
+        try:
+            res = self.bot.client.api.create_filter(self.bot.get_user_id(),
+                                                    definition)
+            self.filter = res["filter_id"]
+            self.logger.info("Sync filter uploaded: %s" % self.filter)
+        except (MatrixRequestError, KeyError), e:
+            self.logger.warning("Sync filter can't be uploaded: %s" % e)
+            return json.dumps(definition)
+        return self.filter
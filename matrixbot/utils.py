@@ -21,6 +21,8 @@ def get_default_settings():
         "ip": "127.0.0.1",
         "port": 11211,
         "timeout": 300,
+        "local_size": 1024,
+        "fetch_workers": 4,
     }
     settings["matrix"] = {
         "uri": "http://localhost:8000",
@@ -30,6 +32,47 @@ def get_default_settings():
         "rooms": [],
         "only_local_domain": False,
     }
+    settings["sync"] = {
+        "timeline_limit": 50,
+        "lazy_load_members": True,
+        "state_file": ".matrixbot.state",
+        "error_backoff_min": 1,
+        "error_backoff_max": 300,
+    }
+    settings["runtime"] = {
+        "mode": "sync",  # sync or threaded
+        "command_workers": 4,
+        "sync_timeout_ms": 30000,
+        "plugin_workers": 4,
+        "plugin_timeout": 120,
+        "scheduler_tick": 1,
+        "janitor_period": 300,
+    }
+    settings["ratelimit"] = {
+        # Requests per second of every endpoint class
+        "rates": {
+            "messages": 5,
+            "membership": 2,
+            "rooms": 1,
+            "default": 10,
+        },
+        "burst": 10,
+        "backoff_min": 1,
+        "backoff_max": 60,
+        "breaker_threshold": 5,
+        "breaker_timeout": 60,
+    }
+    settings["bulk"] = {
+        "workers": 4,
+        "progress_every": 50,
+    }
+    settings["http"] = {
+        # Shared keep-alive connection pools of the bot and the plugins
+        "pool_connections": 10,
+        "max_connections_per_host": 16,
+        "connect_timeout": 10,
+        "read_timeout": 90,  # Longer than the sync long-poll
+    }
     settings["ldap"] = {
         "server": "ldap://ldap.local",
         "base": "ou=People,dc=example,dc=com",
@@ -38,6 +81,16 @@ def get_default_settings():
         "groups_filter": "(objectClass=posixGroup)",
         "groups_base": "ou=Group,dc=example,dc=com",
         "users_aliases": {},
+        "snapshot_ttl": 300,  # Refresh period of the groups members
+        "snapshot_shared": True,  # Shared through memcached
+        "incremental": False,  # Poll the changed groups (modifyTimestamp)
+        "incremental_period": 10,
+        "pool_size": 4,  # Persistent connections kept per server
+        "network_timeout": 10,
+        "query_timeout": 30,
+        "check_interval": 60,  # Idle seconds before checking a connection
+        "page_size": 500,  # Paged results size (0 disables paging)
+        "batch_size": 50,  # Groups fetched per search
     }
     settings["aliases"] = {
     }
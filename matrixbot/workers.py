@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import Queue
+import threading
+import time
+import traceback
+
+from . import utils
+
+
+class WorkerPool():
+    '''Bounded pool of daemon worker threads.
+
+Jobs are identified by a key: a job is skipped while a previous job with the
+same key is still queued or running. Jobs running for longer than their
+timeout are reported as overruns (Python threads can't be killed, so the job
+keeps running but it is not submitted again until it ends).
+    '''
+    def __init__(self, size, name="worker"):
+        self.logger = utils.get_logger()
+        self.name = name
+        self.tasks = Queue.Queue()
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.overruns = 0
+        self.size = int(size)
+        for i in range(self.size):
+            t = threading.Thread(target=self._worker, name="%s-%s" % (name, i))
+            t.daemon = True
+            t.start()
+
+    def submit(self, key, name, timeout, func, *args):
+        with self.lock:
+            if key in self.jobs:
+                self.logger.debug("%s is still running. Skipping" % name)
+                return False
+            self.jobs[key] = {
+                "name": name,
+                "timeout": timeout,
+                "started": None,
+                "reported": False,
+            }
+        self.tasks.put((key, func, args))
+        return True
+
+    def stop(self):
+        for i in range(self.size):
+            self.tasks.put((None, None, None))
+
+    def check_overruns(self):
+        now = time.time()
+        with self.lock:
+            for job in self.jobs.values():
+                if (
+                    job["started"] and not job["reported"]
+                    and job["timeout"]
+                    and now > job["started"] + job["timeout"]
+                ):
+                    job["reported"] = True
+                    self.overruns += 1
+                    self.logger.warning(
+                        "%s overran its deadline of %s seconds" % (
+                            job["name"], job["timeout"]))
+
+    def _worker(self):
+        while True:
+            key, func, args = self.tasks.get()
+            if func is None:
+                return
+            with self.lock:
+                job = self.jobs[key]
+                job["started"] = time.time()
+            try:
+                func(*args)
+            except Exception, e:
+                self.logger.error("Error in %s: %s" % (job["name"], e))
+                self.logger.debug(traceback.format_exc())
+            elapsed = time.time() - job["started"]
+            if job["timeout"] and elapsed > job["timeout"]:
+                self.logger.warning(
+                    "%s finished after %.1f seconds (deadline: %s seconds)" % (
+                        job["name"], elapsed, job["timeout"]))
+            with self.lock:
+                del self.jobs[key]